@@ -4,11 +4,24 @@ import sys
 import errno
 import argparse
 import logging
+import threading
+from concurrent.futures import ThreadPoolExecutor
 
 logging.basicConfig()
 logger = logging.getLogger(__name__)
 logger.propagate = False
 
+# Most directory file descriptors a Linker will hold open at once, kept well
+# under the usual limit of 1024 open files per process
+MAX_DIR_FDS = 256 if (os.symlink in os.supports_dir_fd
+                      and hasattr(os, "O_DIRECTORY")) else 0
+
+# Files with these extensions are release clutter Plex has no use for, they
+# are skipped before their names are parsed. Anything else is linked, which
+# keeps sidecar subtitles (.srt, .sub, .idx...) next to their video
+_SKIP_EXTS = frozenset({".nfo", ".sfv", ".md5", ".par2", ".txt", ".jpg",
+                        ".jpeg", ".png", ".nzb", ".url"})
+
 def create_path(path):
     """
     Make directory structure `path` (including all parents) on the system, or
@@ -33,14 +46,35 @@ def remove_path(path):
             raise exception
 
 
+_WS_TABLE = str.maketrans({".": " ", "-": " ", "_": " "})
+
+
 def put_whitespace(in_str):
     """
     Replace periods (.), underscores (_) and hyphens (-) in `in_str` with spaces
     """
-    return in_str.replace(".", " ").replace("-", " ").replace("_", " ")
+    return in_str.translate(_WS_TABLE)
+
 
+def _build_formatter(groups, plex_name_format, plex_dir_format):
+    """
+    Get a function taking a match of a title and returning the filename and
+    directory structure Plex expects for it, without building a dictionary of
+    metadata along the way
 
-class TvFormat(object):
+    The formats are given the first of `groups` with `put_whitespace` applied
+    as {0}, the rest of `groups` as {1}, {2}... and the title as {title}
+    """
+    def format_fn(match):
+        # match.group() with a single name gives a str rather than a tuple
+        name, *fields = [match.group(group) for group in groups]
+        name = put_whitespace(name)
+        return (plex_name_format.format(name, *fields, title=match.string),
+                plex_dir_format.format(name, *fields))
+    return format_fn
+
+
+class TvFormat:
     """
     See article 16.4, at line 526:
     https://raw.githubusercontent.com/hinfaits/plex-linker/master/doc/The.720p.TV.x264.Releasing.Standards.2016-TVx264
@@ -48,42 +82,55 @@ class TvFormat(object):
     @staticmethod
     def get(title):
         """
-        Get the corresponding subclass of `TvFormat` for `title`
+        Get the corresponding subclass of `TvFormat` for `title`, along with
+        the match object so callers don't have to match `title` again
         """
-        formats = (Weekly, Mini, Daily, Single, Other)
-        for format in formats:
-            if re.search(format.title_format, title, re.IGNORECASE) is not None:
-                return format
-        # Other should be matched and None should never be returned
-        return None
+        # A single pass over `title` tries every format in order of
+        # precedence, the outermost group which matched names the format
+        match = _TITLE_PATTERN.match(title)
+        return _FORMATS_BY_NAME[match.lastgroup], match
 
     @classmethod
     def metadata(cls, title):
         """
         Get a dictionary of metadata extracted from `title`
         """
-        res = re.search(cls.title_format, title, re.IGNORECASE)
-        ret = dict()
-        if res is not None:
-            for i in range(len(cls.groups)):
-                ret[cls.groups[i]] = res.group(i + 1)
-            return ret
+        return cls.metadata_from_match(cls._pattern.match(title))
+
+    @classmethod
+    def metadata_from_match(cls, match):
+        """
+        Get a dictionary of metadata from `match`, a match already made
+        against `cls._pattern` or `_TITLE_PATTERN`
+        """
+        if match is not None:
+            return {group: match.group(cls._prefix + group)
+                    for group in cls.groups}
         else:
             return None
 
+    @staticmethod
+    def _format_fn(match):
+        """
+        Get the filename and directory structure Plex expects for the title
+        matched by `match`, a match already made against `cls._pattern` or
+        `_TITLE_PATTERN`
+        """
+        raise NotImplementedError("Implemented by subclass.")
+
     @classmethod
     def plex_name(cls, title):
         """
         Get the filename Plex expects for `title`
         """
-        raise NotImplementedError("Implemented by subclass.")
+        return cls._format_fn(cls._pattern.match(title))[0]
 
     @classmethod
     def plex_dir(cls, title):
         """
         Get the directory structure Plex expects for `title`
         """
-        raise NotImplementedError("Implemented by subclass.")
+        return cls._format_fn(cls._pattern.match(title))[1]
 
     @classmethod
     def dir(cls, title):
@@ -97,25 +144,15 @@ class Single(TvFormat):
     """
     Covers 16.4.1 of the scene naming standards (720p 2016)
     """
-    title_format = "^(.+)\.(\d\d\d\d)\..+$"
+    _pattern = re.compile(r"^(?P<s_name>.+)\.(?P<s_year>\d\d\d\d)\..+$",
+                          re.IGNORECASE)
+    _prefix = "s_"
     groups = ("name", "year",)
-
-    @classmethod
-    def plex_name(cls, title):
-        data = cls.metadata(title)
-        return "{} - {} - {}".format(
-            put_whitespace(data['name']),
-            data['year'],
-            title
-        )
-
-    @classmethod
-    def plex_dir(cls, title):
-        data = cls.metadata(title)
-        return os.path.join(
-            put_whitespace(data['name']),
-            put_whitespace("{}".format(data['year']))
-        )
+    _format_fn = staticmethod(_build_formatter(
+        ("s_name", "s_year"),
+        "{0} - {1} - {title}",
+        os.path.join("{0}", "{1}")
+    ))
 
     @classmethod
     def dir(cls, title):
@@ -127,26 +164,15 @@ class Weekly(TvFormat):
     """
     Covers 16.4.2, 16.4.3, 16.4.4 of the scene naming standards (720p 2016)
     """
-    title_format = "^(.+)\.S(\d+)E([^\.]+)\..+$"
+    _pattern = re.compile(r"^(?P<w_name>.+)\.S(?P<w_season>\d+)"
+                          r"E(?P<w_episode>[^\.]+)\..+$", re.IGNORECASE)
+    _prefix = "w_"
     groups = ("name", "season", "episode",)
-
-    @classmethod
-    def plex_name(cls, title):
-        data = cls.metadata(title)
-        return "{} - s{}e{} - {}".format(
-            put_whitespace(data['name']),
-            data['season'],
-            data['episode'],
-            title
-        )
-
-    @classmethod
-    def plex_dir(cls, title):
-        data = cls.metadata(title)
-        return os.path.join(
-            put_whitespace(data['name']),
-            "Season {}".format(data['season'])
-        )
+    _format_fn = staticmethod(_build_formatter(
+        ("w_name", "w_season", "w_episode"),
+        "{0} - s{1}e{2} - {title}",
+        os.path.join("{0}", "Season {1}")
+    ))
 
     @classmethod
     def dir(cls, title):
@@ -158,25 +184,15 @@ class Mini(TvFormat):
     """
     Covers 16.4.5 of the scene naming standards (720p 2016)
     """
-    title_format = "^(.+)\.Part\.([^\.]+)\..+$"
+    _pattern = re.compile(r"^(?P<m_name>.+)\.Part\.(?P<m_part>[^\.]+)\..+$",
+                          re.IGNORECASE)
+    _prefix = "m_"
     groups = ("name", "part",)
-
-    @classmethod
-    def plex_name(cls, title):
-        data = cls.metadata(title)
-        return "{} - s01e{} - {}".format(
-            put_whitespace(data['name']),
-            data['part'],
-            title
-        )
-
-    @classmethod
-    def plex_dir(cls, title):
-        data = cls.metadata(title)
-        return os.path.join(
-            put_whitespace(data['name']),
-            "Season 01"
-        )
+    _format_fn = staticmethod(_build_formatter(
+        ("m_name", "m_part"),
+        "{0} - s01e{1} - {title}",
+        os.path.join("{0}", "Season 01")
+    ))
 
     @classmethod
     def dir(cls, title):
@@ -188,27 +204,16 @@ class Daily(TvFormat):
     """
     Covers 16.4.6 of the scene naming standards (720p 2016)
     """
-    title_format = "^(.+)\.(\d\d\d\d)\.(\d\d)\.(\d\d)\..+$"
+    _pattern = re.compile(r"^(?P<d_name>.+)\.(?P<d_year>\d\d\d\d)"
+                          r"\.(?P<d_month>\d\d)\.(?P<d_day>\d\d)\..+$",
+                          re.IGNORECASE)
+    _prefix = "d_"
     groups = ("name", "year", "month", "day",)
-
-    @classmethod
-    def plex_name(cls, title):
-        data = cls.metadata(title)
-        return "{} - {} {} {} - {}".format(
-            put_whitespace(data['name']),
-            data['year'],
-            data['month'],
-            data['day'],
-            title
-        )
-
-    @classmethod
-    def plex_dir(cls, title):
-        data = cls.metadata(title)
-        return os.path.join(
-            put_whitespace(data['name']),
-            "{}".format(data['year'])
-        )
+    _format_fn = staticmethod(_build_formatter(
+        ("d_name", "d_year", "d_month", "d_day"),
+        "{0} - {1} {2} {3} - {title}",
+        os.path.join("{0}", "{1}")
+    ))
 
     @classmethod
     def dir(cls, title):
@@ -220,82 +225,237 @@ class Other(TvFormat):
     """
     Matches any format
     """
-    title_format = ".*"
+    _pattern = re.compile(r".*")
+    _prefix = ""
     groups = tuple()
 
-    @classmethod
-    def plex_name(cls, title):
-        return title
-
-    @classmethod
-    def plex_dir(cls, title):
-        return "Uncategorized"
+    @staticmethod
+    def _format_fn(match):
+        return match.string, "Uncategorized"
 
     @classmethod
     def dir(cls, title):
         return "Uncategorized".lower()
 
 
-class Show(object):
+# Formats in order of precedence, Other matches anything and must be last
+_FORMATS = (Weekly, Mini, Daily, Single, Other)
+_FORMATS_BY_NAME = {format.__name__: format for format in _FORMATS}
+
+_TITLE_PATTERN = re.compile(
+    "|".join(f"(?P<{format.__name__}>{format._pattern.pattern})"
+             for format in _FORMATS),
+    re.IGNORECASE
+)
+
+
+class Show:
     def __init__(self, filename, filepath):
         self.name = filename
         self.path = filepath
-        self.format = TvFormat.get(self.name)
+        self.format, self._match = TvFormat.get(self.name)
+        # The Plex paths are all that's needed for every file, work them out
+        # once and straight from the match
+        self._plex_name, self._plex_dir = self.format._format_fn(self._match)
 
     def metadata(self):
-        return self.format.metadata(self.name)
+        return self.format.metadata_from_match(self._match)
 
     def plex_dir(self):
-        return self.format.plex_dir(self.name)
+        return self._plex_dir
 
     def plex_name(self):
-        return self.format.plex_name(self.name)
+        return self._plex_name
 
 
-class Linker(object):
-    def __init__(self, source_dir, target_dir):
+class Linker:
+    def __init__(self, source_dir, target_dir, workers=1):
         """
         `source_dir` is where Linker() should look for files, `target_dir` is 
-        where Linker() should make links
+        where Linker() should make links, `workers` is how many threads may
+        be waiting on the filesystem at once (worth raising on slow or network
+        storage, local syscalls are cheaper than handing them to a thread)
         """
         self.source_dir = source_dir
         self.target_dir = target_dir
+        self.workers = workers
+        # `target_dir` with exactly one trailing separator, so per file paths
+        # can be built by concatenation rather than `os.path.join`
+        self._target_prefix = os.path.join(target_dir, "")
+        # Directories known to exist in `target_dir` during a `make_links`,
+        # mapped to a file descriptor open on the directory or None once
+        # MAX_DIR_FDS are open
+        self._dir_fds = dict()
+        self._dir_fds_open = 0
+        self._dir_fds_lock = threading.Lock()
+
+    def _scan(self, root):
+        """
+        Recursively yield `(path, entry)` for every file found under `root`,
+        where `path` is the directory containing the `os.DirEntry` `entry`
 
-    def make_links(self):
-        for path, dirs, files in os.walk(self.source_dir):
-            # path is the directory we're in
-            # dirs are the directories found
-            # files are the files found
-            for name in files:
-                pathname = os.path.join(path, name)
-                show = Show(name, path)
-                plex_path = os.path.join(self.target_dir, show.plex_dir())
-                plex_name = show.plex_name()
-                plex_pathname = os.path.join(plex_path, plex_name)
-                create_path(plex_path)
+        Like `os.walk`, symlinks to directories are not followed and
+        directories which can't be read are skipped
+        """
+        try:
+            entries = os.scandir(root)
+        except OSError:
+            return
+        with entries:
+            while True:
+                try:
+                    entry = next(entries)
+                except StopIteration:
+                    break
+                except OSError:
+                    # Stop reading this directory, as `os.walk` does
+                    return
+                try:
+                    is_dir = entry.is_dir()
+                except OSError:
+                    # `os.walk` treats entries it can't stat as files
+                    is_dir = False
+                if not is_dir:
+                    yield root, entry
+                    continue
                 try:
-                    # OSError.EEXIST will be raised if the link already exists
-                    os.symlink(pathname, plex_pathname)
-                    logger.info("Made symlink {} -> {}".format(plex_pathname,
-                                                               pathname))
-                except OSError as exception:
-                    if exception.errno != errno.EEXIST:
-                        raise
-                    logger.debug("Symlink already exists at {}".format(plex_pathname))
+                    is_symlink = entry.is_symlink()
+                except OSError:
+                    is_symlink = False
+                if not is_symlink:
+                    yield from self._scan(entry.path)
 
-    def delete_broken_links(self):
-        for path, dirs, files in os.walk(self.target_dir):
-            for name in files:
-                pathname = os.path.join(path, name)
+    def _source_files(self):
+        """
+        Yield `(path, entry)` for every file worth linking under
+        `self.source_dir` like `_scan`, skipping release clutter and hard
+        links to a file which was already yielded
+        """
+        devices = dict()
+        seen = set()
+        for path, entry in self._scan(self.source_dir):
+            name = entry.name
+            if name[name.rfind("."):].lower() in _SKIP_EXTS:
+                continue
+            # A file is on the same device as its directory, so one stat per
+            # directory goes with the inode number readdir already gave us
+            if path not in devices:
                 try:
-                    # OSError.ENOENT will be raised if the link is broken
-                    os.stat(pathname)
-                except OSError as exception:
-                    if exception.errno != errno.ENOENT:
-                        raise
-                    else:
-                        os.remove(pathname)
-                        logger.info("Removed broken symlink {}".format(pathname))
+                    devices[path] = os.stat(path).st_dev
+                except OSError:
+                    # The directory went away or can't be read, carry on as
+                    # `_scan` does and link its files without deduplicating
+                    devices[path] = None
+            device = devices[path]
+            if device is not None:
+                key = (device, entry.inode())
+                if key in seen:
+                    continue
+                seen.add(key)
+            yield path, entry
+
+    def _run(self, func, items):
+        """
+        Call `func(*item)` for each of `items` on a pool of `self.workers`
+        threads, re-raising the first exception any of the calls raised
+
+        The calls spend nearly all their time in syscalls, which release the
+        GIL, so the pool keeps many of them in flight at once. With a single
+        worker the calls are made in turn here, without a pool
+        """
+        if self.workers <= 1:
+            for item in items:
+                func(*item)
+            return
+        with ThreadPoolExecutor(max_workers=self.workers) as executor:
+            futures = [executor.submit(func, *item) for item in items]
+            for future in futures:
+                future.result()
+
+    def _open_dir(self, path):
+        """
+        `create_path(path)` unless this `Linker` has already done so, then get
+        a file descriptor open on `path` or None if none could be kept open
+        """
+        try:
+            return self._dir_fds[path]
+        except KeyError:
+            pass
+        with self._dir_fds_lock:
+            if path not in self._dir_fds:
+                create_path(path)
+                fd = None
+                if self._dir_fds_open < MAX_DIR_FDS:
+                    fd = os.open(path, os.O_RDONLY | os.O_DIRECTORY)
+                    self._dir_fds_open += 1
+                self._dir_fds[path] = fd
+            return self._dir_fds[path]
+
+    def _close_dirs(self):
+        """
+        Close the file descriptors opened by `_open_dir` and forget the
+        directories, which may be gone by the next `make_links`
+        """
+        with self._dir_fds_lock:
+            for fd in self._dir_fds.values():
+                if fd is not None:
+                    os.close(fd)
+            self._dir_fds.clear()
+            self._dir_fds_open = 0
+
+    def _link_one(self, path, entry):
+        """
+        Make the symlink in `self.target_dir` for the file `entry` found in
+        the directory `path`
+        """
+        name = entry.name
+        pathname = entry.path
+        show = Show(name, path)
+        plex_path = self._target_prefix + show.plex_dir()
+        plex_name = show.plex_name()
+        plex_pathname = plex_path + os.sep + plex_name
+        dir_fd = self._open_dir(plex_path)
+        try:
+            # OSError.EEXIST will be raised if the link already exists
+            if dir_fd is not None:
+                # Resolve only `plex_name`, not all of `plex_pathname`
+                os.symlink(pathname, plex_name, dir_fd=dir_fd)
+            else:
+                os.symlink(pathname, plex_pathname)
+            logger.info("Made symlink %s -> %s", plex_pathname, pathname)
+        except OSError as exception:
+            if exception.errno != errno.EEXIST:
+                raise
+            logger.debug("Symlink already exists at %s", plex_pathname)
+
+    def _remove_if_broken(self, path, entry):
+        """
+        Remove the symlink `entry` found in the directory `path` if the file
+        it points to no longer exists
+        """
+        pathname = entry.path
+        try:
+            # OSError.ENOENT will be raised if the link is broken
+            entry.stat()
+        except OSError as exception:
+            if exception.errno != errno.ENOENT:
+                raise
+            else:
+                os.remove(pathname)
+                logger.info("Removed broken symlink %s", pathname)
+
+    def make_links(self):
+        # The directory tree is read here, the links are made by the pool
+        try:
+            self._run(self._link_one, self._source_files())
+        finally:
+            self._close_dirs()
+
+    def delete_broken_links(self):
+        # Only a symlink can be broken, don't pay for a stat on real files
+        self._run(self._remove_if_broken,
+                  ((path, entry) for path, entry in self._scan(self.target_dir)
+                   if entry.is_symlink()))
 
 
 def main():
@@ -303,6 +463,7 @@ def main():
     parser.add_argument("source", type=str, help="Directory containing your TV")
     parser.add_argument("destination", type=str, help="The directory for symlinks to be made in")
     parser.add_argument("--verbose", "-v", action="store_true", help="Enable verbose output")
+    parser.add_argument("--workers", "-j", type=int, default=1, help="Threads making links at once, helps on network storage")
     args = parser.parse_args()
 
     console_handler = logging.StreamHandler(sys.stdout)
@@ -314,13 +475,13 @@ def main():
         logger.setLevel(level=logging.INFO)
 
     if not os.path.exists(args.source):
-        logger.error("Source path [{}] not found.".format(args.source))
+        logger.error("Source path [%s] not found.", args.source)
         return 1
     if not os.path.exists(args.destination):
-        logger.error("Destination path [{}] not found.".format(args.destination))
+        logger.error("Destination path [%s] not found.", args.destination)
         return 1
 
-    linker = Linker(args.source, args.destination)
+    linker = Linker(args.source, args.destination, workers=args.workers)
     linker.make_links()
     linker.delete_broken_links()
 
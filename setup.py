@@ -9,5 +9,6 @@ setup(name='plex-linker',
       author_email='hinfaits@users.noreply.github.com',
       url='https://github.com/hinfaits/plex-linker',
       packages=['plex_linker',],
+      python_requires='>=3.8',
       entry_points={'console_scripts': ['plex-linker=plex_linker.app:main'],},
      )